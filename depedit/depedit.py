@@ -12,16 +12,26 @@ Author: Amir Zeldes
 from __future__ import print_function
 
 import argparse
+import errno
+import hashlib
+import json
+import os
 import re
 import sys
 from collections import defaultdict
 from copy import copy, deepcopy
 from glob import glob
-from io import open as io_open
+from operator import attrgetter
+from io import BufferedWriter, TextIOWrapper, open as io_open
+from timeit import default_timer as timer
 
-from six import iteritems
+from six import iteritems, string_types
+from six.moves import queue
 
 __version__ = "2.1.2"
+# Format of the code generated by Transformation.generate_source; bump it whenever generate_source,
+# generate_relation or generate_action change, so that cached sources from older generators are not reused
+COMPILE_FORMAT = 1
 
 
 def escape(string, symbol_to_mask, border_marker):
@@ -63,19 +73,31 @@ class Sentence:
         self.sentence_string = sentence_string
         self.length = 0
         self.annotations = {}
-        self.sent_num = 0
+        self.sent_num = sent_num
+        self.sent_id = None
+        self.tokens = []
+        self.tokoffset = 0
 
     def print_annos(self):
         return ["# " + key + "=" + val for (key, val) in iteritems(self.annotations)]
 
 
 ALIASES = dict(form="text", upostag="pos", xpostag="cpos", feats="morph", deprel="func", deps="head2", misc="func2")
+FIELDS = ("id", "text", "lemma", "pos", "cpos", "morph", "head", "func", "head2", "func2")  # In CoNLL column order
+FIELD_ALIASES = dict((target, alias) for alias, target in ALIASES.items())
+get_fields = attrgetter(*FIELDS)
 
 
 class Transformation:
 
     def parse_transformation(self, transformation_text):
         split_trans = transformation_text.split("\t")
+        if self.query:  # Match-only pattern with no actions, relations default to 'none'
+            if len(split_trans) == 1:
+                split_trans.append("none")
+            if len(split_trans) != 2:
+                return None
+            split_trans.append("")
         if len(split_trans) < 3:
             return None
         definition_string, relation_string, action_string = split_trans
@@ -90,7 +112,7 @@ class Transformation:
         for def_index, esc_string in enumerate(escaped_definitions):
             definitions.append(DefinitionMatcher(esc_string, def_index + 1))
         relations = relation_string.split(";")
-        actions = action_string.strip().split(";")
+        actions = action_string.strip().split(";") if not self.query else []
         aliased_actions = []
         for action in actions:
             aliased_actions.append(self.handle_aliases(action))
@@ -112,15 +134,299 @@ class Transformation:
                                       r'\1\2\3;\3\4', criterion_string)
         return criterion_string
 
-    def __init__(self, transformation_text, line):
+    def __init__(self, transformation_text, line, query=False):
+        self.query = query
         instructions = self.parse_transformation(transformation_text)
         if instructions is None:
-            print("Depedit says: error in configuration file\n"
-                  "Malformed instruction on line " + str(line) + " (instruction lines must contain exactly two tabs)",
-                  file=sys.stderr)
+            if query:
+                print("Depedit says: error in query\n"
+                      "Malformed query (queries contain definitions and optionally relations separated by one tab)",
+                      file=sys.stderr)
+            else:
+                print("Depedit says: error in configuration file\n"
+                      "Malformed instruction on line " + str(line) + " (instruction lines must contain exactly two tabs)",
+                      file=sys.stderr)
             sys.exit()
         self.definitions, self.relations, self.actions = instructions
+        self.eval_definitions = self.definitions
         self.line = line
+        self.text = transformation_text
+        self.compiled = self.compiled_source = None
+
+    def optimize_order(self):
+        """
+        Order definitions so that those most likely to find no candidate nodes in a sentence, relative to their cost,
+        are evaluated first. A definition with no candidates means the transformation cannot apply, so remaining
+        definitions and all relations can be skipped without affecting results.
+
+        :return: void
+        """
+        for definition in self.definitions:
+            definition.optimize_order()
+        self.eval_definitions = sorted(self.definitions, key=lambda d: rank(d.time, d.sentences, d.empty))
+
+    def generate_source(self):
+        """
+        Generate Python source for a matcher and an action function specialized to this transformation, with field
+        accesses, literal comparisons, relation tests and actions inlined. Relations the generator does not recognize
+        fall back to DepEdit.matches_relation, and merging partial matches always uses DepEdit.merge_sets.
+
+        :return: source code defining match(depedit, conll_tokens) and act(depedit, result_sets)
+        """
+        lines = ["# DepEdit " + __version__ + " compiled transformation from line " + str(self.line) +
+                 " (format " + str(COMPILE_FORMAT) + ")",
+                 "# " + self.text.strip().replace("\n", " "),
+                 "# Match and timer are provided by DepEdit when this source is compiled",
+                 "", "import re", "import sys", "from collections import defaultdict"]
+        regexes = []
+
+        def _regex(pattern):
+            name = "_re" + str(len(regexes) + 1)
+            regexes.append(name + " = re.compile(" + repr(pattern) + ")")
+            return name
+
+        body = ["def match(depedit, conll_tokens):",
+                "    depedit.pairs = 0",
+                "    if depedit.max_rule_time:",
+                "        depedit.rule_deadline = timer() + depedit.max_rule_time",
+                "    budgeted = depedit.has_budget()",
+                "    node_matches = defaultdict(list)"]
+        for def_matcher in self.eval_definitions:
+            index = def_matcher.def_index
+            body += ["    matches = []", "    for token in conll_tokens:", "        if token.is_super_tok:",
+                     "            continue"]
+            group_names = []
+            for def_item in def_matcher.eval_defs:
+                field = "token." + def_item.criterion
+                if def_item.match_func == Definition.return_true:
+                    continue
+                elif def_item.match_func == Definition.return_exact:
+                    body.append("        if " + field + " != " + repr(def_item.value) + ":")
+                elif def_item.match_func == Definition.return_exact_negative:
+                    body.append("        if " + field + " == " + repr(def_item.value) + ":")
+                elif def_item.match_func == Definition.return_regex_negative:
+                    body.append("        if " + _regex(def_item.value) + ".search(" + field + "):")
+                else:
+                    match_name = "m" + str(def_item.position)
+                    group_names.append((def_item.position, match_name))
+                    body += ["        " + match_name + " = " + _regex(def_item.value) + ".search(" + field + ")",
+                             "        if not " + match_name + ":"]
+                body.append("            continue")
+            body.append("        groups = []")
+            for position, match_name in sorted(group_names):  # Bracket groups in textual order
+                body += ["        found = " + match_name + ".groups()", "        if found:",
+                         "            groups.append(found)"]
+            body += ["        matches.append(Match(" + str(index) + ", token, groups))",
+                     "    if not matches:", "        return []",
+                     "    node_matches[" + str(index) + "] = matches"]
+
+        body.append("    result_sets = []")
+        for relation in self.relations:
+            body += ["    # Relation " + relation] + self.generate_relation(relation)
+        body += ["    return depedit.merge_sets(result_sets, " + str(len(self.definitions)) + ", " +
+                 str(len(self.relations)) + ")", ""]
+
+        uses_groups = False
+        act = ["def act(depedit, result_sets):"]
+        for action in self.actions:
+            for command in action.split(";"):
+                try:
+                    code, command_uses_groups = self.generate_action(command)
+                except (IndexError, ValueError):  # Leave malformed actions to fail as they would when interpreted
+                    code = ["if depedit.execute_action([result], " + repr(command) + ") == 'last':",
+                            "    return 'last'"]
+                    command_uses_groups = True
+                uses_groups = uses_groups or command_uses_groups
+                if code:
+                    act += ["    for result in result_sets:", "        if result:"] + \
+                           ["            " + line for line in code]
+        if uses_groups:
+            act.insert(1, "    depedit.add_groups(result_sets)")
+        act.append("    return None")
+
+        if regexes:
+            lines += [""] + regexes
+        return "\n".join(lines + ["", ""] + body + [""] + act) + "\n"
+
+    def generate_relation(self, relation):
+        """
+        Generate code equivalent to DepEdit.matches_relation for one relation, with its operator resolved up front
+
+        :param relation: relation string, e.g. '#1>#2', '#1.1,5#2', '#1:lemma==#2' or 'none'
+        :return: list of source lines
+        """
+        fallback = ["    if not depedit.matches_relation(node_matches, " + repr(relation) + ", result_sets):",
+                    "        result_sets = []"]
+        if not relation:
+            return ["    result_sets = []"]
+        if relation == "none":
+            return ["    for matcher1 in node_matches[1]:",
+                    "        result_sets.append({1: matcher1.token, 'rel': 'none', 'matchers': [matcher1]})",
+                    "    if not node_matches[1]:", "        result_sets = []"]
+        try:
+            field = None
+            if "==" in relation:
+                m = re.search(r':(.+)==', relation)
+                operator = m.group()
+                field = m.group(1)
+            elif "." in relation:
+                if re.match(r'.*\.[0-9]', relation):
+                    m = re.match(r'.*\.[0-9]*,?[0-9]*#', relation)
+                    operator = m.group()
+                    operator = operator[operator.find("."):operator.rfind("#")]
+                else:
+                    operator = "."
+            elif ">" in relation:
+                operator = ">"
+            else:
+                return fallback
+            node1, node2 = [int(node.replace("#", "")) for node in relation.split(operator)]
+        except (AttributeError, ValueError):
+            return fallback
+        if field is not None and not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', field):
+            return fallback
+
+        code = ["    nm1 = node_matches[" + str(node1) + "]", "    nm2 = node_matches[" + str(node2) + "]",
+                "    hits = 0", "    found1 = set()", "    found2 = found1" if node1 == node2 else "    found2 = set()",
+                "    if nm1 and nm2:"]
+        if field is not None:
+            code.append("        keys2 = [matcher2.token." + field + " for matcher2 in nm2]")
+            key1 = "tok1." + field
+            test = "key2 == key1"
+        elif operator == ">":
+            code.append("        keys2 = [int(float(matcher2.token.head)) for matcher2 in nm2]")
+            key1 = "int(float(tok1.id))"
+            test = "key2 == key1"
+        else:
+            code.append("        keys2 = [int(float(matcher2.token.id)) for matcher2 in nm2]")
+            key1 = "int(float(tok1.id))"
+            if operator == ".":
+                test = "key2 == key1 + 1"
+            else:
+                m = re.match(r'\.([0-9]+)(,[0-9]+)?', operator)
+                min_dist = int(m.group(1))
+                max_dist = int(m.group(2).replace(",", "")) if m.group(2) is not None else min_dist
+                test = str(max_dist) + " >= key2 - key1 >= " + str(min_dist)
+        code += ["        for matcher1 in nm1:",
+                 "            tok1 = matcher1.token",
+                 "            if budgeted:",
+                 "                depedit.pairs += len(nm2)",
+                 "                depedit.check_budget()",
+                 "            key1 = " + key1,
+                 "            for matcher2, key2 in zip(nm2, keys2):",
+                 "                if " + test + ":",
+                 "                    tok2 = matcher2.token",
+                 "                    result_sets.append({" + str(node1) + ": tok1, " + str(node2) + ": tok2, 'rel': " +
+                 repr(relation) + ", 'matchers': [matcher1, matcher2]})",
+                 "                    found1.add(tok1)",
+                 "                    found2.add(tok2)",
+                 "                    hits += 1",
+                 "    node_matches[" + str(node1) + "] = [matcher for matcher in nm1 if matcher.token in found1]",
+                 "    node_matches[" + str(node2) + "] = [matcher for matcher in node_matches[" + str(node2) +
+                 "] if matcher.token in found2]",
+                 "    if not hits:",
+                 "        result_sets = []"]
+        return code
+
+    @staticmethod
+    def generate_action(action):
+        """
+        Generate code equivalent to DepEdit.execute_action for one action command applied to a result
+
+        :param action: a single action, e.g. '#1:func=nsubj', '#2>#1', '#S:type=q' or 'last'
+        :return: tuple of source lines and whether the action uses regex bracket groups
+        """
+        if action == "last":
+            return ["return 'last'"], False
+        elif ":" in action:
+            if action.startswith("#S:"):
+                key, val = action.split(":")[1].split("=", 1)
+                return ["result[1].sentence.annotations[" + repr(key) + "] = " + repr(val)], False
+            node_position = int(action[1:action.find(":")])
+            prop = action[action.find(":") + 1:action.find("=")]
+            value = action[action.find("=") + 1:].strip()
+            group_num_matches = re.findall(r"(\$[0-9]+[LU]?)", value)
+            if not group_num_matches:
+                return ["setattr(result[" + str(node_position) + "], " + repr(prop) + ", " + repr(value) + ")"], False
+            code = ["value = " + repr(value)]
+            for g in group_num_matches:
+                no_dollar = g[1:]
+                case = suffix = ""
+                if no_dollar[-1] == "U":
+                    case, suffix = ".upper()", "U"
+                    no_dollar = no_dollar[0:-1]
+                elif no_dollar[-1] == "L":
+                    case, suffix = ".lower()", "L"
+                    no_dollar = no_dollar[0:-1]
+                group_num = int(no_dollar)
+                message = "The action '" + action + "' refers to a missing regex bracket group '$" + str(group_num) + \
+                          "'\n"
+                code += ["try:",
+                         "    group_value = result['groups'][" + str(group_num - 1) + "]" + case,
+                         "except IndexError:",
+                         "    sys.stderr.write(" + repr(message) + ")",
+                         "    sys.exit()",
+                         "value = re.sub(" + repr(r"\$" + str(group_num) + suffix) + ", group_value, value)"]
+            code.append("setattr(result[" + str(node_position) + "], " + repr(prop) + ", value)")
+            return code, True
+        elif ">" in action:
+            node1 = int(action.split(">")[0].replace("#", ""))
+            node2 = int(action.split(">")[1].replace("#", ""))
+            return ["tok1 = result[" + str(node1) + "]", "tok2 = result[" + str(node2) + "]", "if tok1 != tok2:",
+                    "    tok2.head = tok1.id"], False
+        return [], False
+
+    def compile(self, cache_dir="", quiet=False):
+        """
+        Compile the specialized matcher and action functions for this transformation. If cache_dir is given, the
+        generated source is stored there for inspection and reused on later runs. If the cache cannot be used, the
+        source is compiled in memory only.
+
+        :param cache_dir: directory for generated source files, or '' to keep the source in memory only
+        :param quiet: do not warn if the cache cannot be used
+        :return: False if cache_dir was given but could not be used, otherwise True
+        """
+        source = None
+        filename = "<depedit line " + str(self.line) + ">"
+        cached = True
+        if cache_dir:
+            order = [(d.def_index, [def_item.position for def_item in d.eval_defs]) for d in self.eval_definitions]
+            key = hashlib.sha1((__version__ + "\t" + str(COMPILE_FORMAT) + "\t" + self.text + "\t" +
+                                str(order)).encode("utf8")).hexdigest()
+            cache_name = os.path.join(cache_dir, "line_" + str(self.line) + "_" + key[:16] + ".py")
+            if os.path.isfile(cache_name):
+                try:
+                    with io_open(cache_name, encoding="utf8") as f:
+                        source = f.read()
+                    filename = cache_name
+                except (IOError, OSError):  # Unreadable, so generate the source again below
+                    pass
+        if source is None:
+            source = self.generate_source()
+            if cache_dir:
+                temp_name = cache_name + "." + str(os.getpid()) + ".tmp"
+                try:
+                    if not os.path.isdir(cache_dir):
+                        try:
+                            os.makedirs(cache_dir)
+                        except OSError:  # Created concurrently by another process, otherwise writing fails below
+                            pass
+                    with io_open(temp_name, "w", encoding="utf8") as f:
+                        f.write(source)
+                    os.rename(temp_name, cache_name)
+                    filename = cache_name
+                except (IOError, OSError) as e:
+                    cached = False
+                    if os.path.isfile(temp_name):
+                        os.remove(temp_name)
+                    if not quiet:
+                        print("DepEdit WARN: cannot write compiled code to cache " + cache_dir + " (" + str(e) +
+                              "), compiling in memory only", file=sys.stderr)
+        namespace = {"Match": Match, "timer": timer}
+        exec(compile(source, filename, "exec"), namespace)
+        self.compiled_source = source
+        self.compiled = (namespace["match"], namespace["act"])
+        return cached
 
     def validate(self):
         report = ""
@@ -164,9 +470,11 @@ class DefinitionMatcher:
         self.def_index = def_index
         self.groups = []
         self.defs = []
+        self.sentences = self.empty = 0
+        self.time = 0.0
 
         def_items = self.def_text.split("&")
-        for def_item in def_items:
+        for position, def_item in enumerate(def_items):
             def_item = def_item.replace("%%%%%", "&")
             criterion = def_item.split("=", 1)[0]
             negative_criterion = (criterion[-1] == "!")
@@ -180,14 +488,21 @@ class DefinitionMatcher:
                 def_value = "^" + def_value
             if def_value[-1] != "$":
                 def_value += "$"
-            self.defs.append(Definition(criterion, def_value, negative_criterion))
+            self.defs.append(Definition(criterion, def_value, negative_criterion, position))
+        self.eval_defs = self.defs
 
     def __repr__(self):
         return "#" + str(self.def_index) + ": " + self.def_text
 
+    def optimize_order(self):
+        """
+        Order criteria so that cheap criteria which often fail are tested first
+        """
+        self.eval_defs = sorted(self.defs, key=lambda d: rank(d.time, d.evals, d.evals - d.hits))
+
     def match(self, token):
         potential_groups = []
-        for def_item in self.defs:
+        for def_item in self.eval_defs:
             tok_value = getattr(token, def_item.criterion)
             match_obj = def_item.match_func(def_item, tok_value)
             if not match_obj:
@@ -195,20 +510,48 @@ class DefinitionMatcher:
             elif match_obj is not True and match_obj is not None:
                 groups = match_obj.groups()
                 if groups:
-                    potential_groups.append(groups)
-        self.groups = potential_groups
+                    potential_groups.append((def_item.position, groups))
+        if len(potential_groups) > 1:
+            potential_groups.sort()  # Keep bracket groups in textual order even if criteria were reordered
+        self.groups = [groups for position, groups in potential_groups]
         return True
 
+    def match_profiled(self, token):
+        """
+        Same as match, but tests every criterion in textual order and records its cost and hit rate
+        """
+        potential_groups = []
+        matched = True
+        for def_item in self.defs:
+            start = timer()
+            match_obj = def_item.match_func(def_item, getattr(token, def_item.criterion))
+            def_item.time += timer() - start
+            def_item.evals += 1
+            if not match_obj:
+                matched = False
+            else:
+                def_item.hits += 1
+                if match_obj is not True and match_obj is not None:
+                    groups = match_obj.groups()
+                    if groups:
+                        potential_groups.append(groups)
+        if matched:
+            self.groups = potential_groups
+        return matched
+
 
 class Definition:
 
-    def __init__(self, criterion, value, negative=False):
+    def __init__(self, criterion, value, negative=False, position=0):
         # Handle conllu criterion aliases:
         self.criterion = ALIASES.get(criterion, criterion)
         self.value = value
         self.match_type = ""
         self.compiled_re = self.match_func = None
         self.negative = negative
+        self.position = position
+        self.evals = self.hits = 0
+        self.time = 0.0
         self.set_match_type()
 
     def set_match_type(self):
@@ -243,6 +586,33 @@ class Definition:
         return True
 
 
+def rank(cost, trials, failures):
+    """
+    Sort key for fail-fast evaluation order: average cost per trial divided by the observed failure rate, so that
+    cheap tests which usually fail come first. Tests without statistics keep their relative textual order.
+
+    :param cost: total time spent on the test
+    :param trials: how often the test was run
+    :param failures: how often the test failed
+    :return: a sortable rank, lower is evaluated first
+    """
+    if not trials:
+        return float("inf")
+    return (cost / trials) / max(failures / float(trials), 1e-6)
+
+
+class MatchBudgetExceeded(Exception):
+    """
+    Raised while matching a rule on a sentence once a configured limit on candidate pairs, bins or time is exceeded
+    """
+
+    def __init__(self, limit, value, maximum):
+        Exception.__init__(self, limit + " " + str(value) + " > " + str(maximum))
+        self.limit = limit
+        self.value = value
+        self.maximum = maximum
+
+
 class Match:
 
     def __init__(self, def_index, token, groups):
@@ -260,8 +630,24 @@ class DepEdit:
         self.transformations = []
         self.user_transformation_counter = 0
         self.quiet = False
+        self.warmup = self.profiled_sentences = 0
+        self.max_pairs = self.max_bins = 0
+        self.max_rule_time = self.max_sentence_time = 0.0
         if options:
             self.quiet = options.quiet
+            self.warmup = getattr(options, "warmup", 0)
+            self.max_pairs = getattr(options, "max_pairs", 0)
+            self.max_bins = getattr(options, "max_bins", 0)
+            self.max_rule_time = getattr(options, "max_rule_time", 0.0)
+            self.max_sentence_time = getattr(options, "max_sentence_time", 0.0)
+        self.pairs = 0
+        self.rule_deadline = self.sentence_deadline = None
+        self.budget_skips = 0
+        self.sentence_count = self.token_count = 0
+        self.rule_firings = defaultdict(int)
+        self.metrics = None
+        self.compiled = False
+        self.compile_cache = ""
         if config_file:
             self.read_config_file(config_file)
         self.docname = self.input_mode = None
@@ -297,26 +683,188 @@ class DepEdit:
             print(trans_report, file=sys.stderr)
             sys.exit()
 
-    def process_sentence(self, conll_tokens):
+    def read_stats(self, stats_file):
+        """
+        Load selectivity statistics saved by write_stats and reorder definitions and criteria accordingly.
+
+        :param stats_file: path to a JSON statistics file
+        :return: void
+        """
+        with io_open(stats_file, encoding="utf8") as f:
+            stats = json.load(f)
         for transformation in self.transformations:
-            node_matches = defaultdict(list)
             for def_matcher in transformation.definitions:
-                for token in conll_tokens:
-                    if not token.is_super_tok and def_matcher.match(token):
-                        node_matches[def_matcher.def_index].append(
-                            Match(def_matcher.def_index, token, def_matcher.groups))
-            result_sets = []
-            for relation in transformation.relations:
-                if not self.matches_relation(node_matches, relation, result_sets):
-                    result_sets = []
-            result_sets = self.merge_sets(result_sets, len(transformation.definitions), len(transformation.relations))
+                key = str(transformation.line) + "\t" + def_matcher.def_text
+                if key not in stats or len(stats[key]["criteria"]) != len(def_matcher.defs):
+                    continue
+                def_matcher.sentences, def_matcher.empty, def_matcher.time = stats[key]["definition"]
+                for def_item, (evals, hits, time) in zip(def_matcher.defs, stats[key]["criteria"]):
+                    def_item.evals, def_item.hits, def_item.time = evals, hits, time
+        self.optimize_order()
+
+    def write_stats(self, stats_file):
+        """
+        Save selectivity statistics collected during warm-up or loaded with read_stats.
+
+        :param stats_file: path to write JSON statistics to
+        :return: void
+        """
+        stats = {}
+        for transformation in self.transformations:
+            for def_matcher in transformation.definitions:
+                key = str(transformation.line) + "\t" + def_matcher.def_text
+                stats[key] = {"definition": [def_matcher.sentences, def_matcher.empty, def_matcher.time],
+                              "criteria": [[d.evals, d.hits, d.time] for d in def_matcher.defs]}
+        with open(stats_file, "w") as f:
+            json.dump(stats, f, indent=1, sort_keys=True)
+
+    def optimize_order(self):
+        for transformation in self.transformations:
+            transformation.optimize_order()
+        if self.compiled:  # Regenerate matchers to follow the new order
+            self.compile_transformations(self.compile_cache)
+
+    def compile_transformations(self, cache_dir=""):
+        """
+        Switch to code-generated matchers and actions specialized for each transformation, instead of interpreting
+        the rules generically. Results are identical; see Transformation.compiled_source for the generated code.
+
+        :param cache_dir: optional directory to save generated source to and reuse it from
+        :return: void
+        """
+        self.compiled = True
+        self.compile_cache = cache_dir
+        for transformation in self.transformations:
+            if not transformation.compile(self.compile_cache, quiet=self.quiet):
+                self.compile_cache = ""  # Warned once already, so compile the rest in memory
+
+    def advance_warmup(self):
+        """
+        Count a sentence towards the warm-up window, and reorder evaluation once the window is complete
+        """
+        if self.profiled_sentences >= self.warmup:
+            self.optimize_order()
+            self.warmup = 0
+        else:
+            self.profiled_sentences += 1
+
+    def has_budget(self):
+        return bool(self.max_pairs or self.max_bins or self.max_rule_time or self.max_sentence_time)
+
+    def check_budget(self, bins=0):
+        """
+        Raise MatchBudgetExceeded if the rule being matched has used up its allowance of candidate pairs, bins or time
+
+        :param bins: number of bins currently held by merge_sets
+        :return: void
+        """
+        if self.max_pairs and self.pairs > self.max_pairs:
+            raise MatchBudgetExceeded("pairs", self.pairs, self.max_pairs)
+        if self.max_bins and bins > self.max_bins:
+            raise MatchBudgetExceeded("bins", bins, self.max_bins)
+        if self.max_rule_time or self.max_sentence_time:
+            now = timer()
+            if self.sentence_deadline is not None and now > self.sentence_deadline:
+                raise MatchBudgetExceeded("sentence_time", round(now - self.sentence_deadline + self.max_sentence_time,
+                                                                 3), self.max_sentence_time)
+            if self.rule_deadline is not None and now > self.rule_deadline:
+                raise MatchBudgetExceeded("rule_time", round(now - self.rule_deadline + self.max_rule_time, 3),
+                                          self.max_rule_time)
+
+    def sentence_label(self, sentence):
+        """
+        Identify a sentence for reports, using its sent_id comment if available
+
+        :param sentence: a Sentence object
+        :return: string ID
+        """
+        if sentence.sent_id is not None:
+            return sentence.sent_id
+        return str(self.docname) + "-" + str(sentence.sent_num)
+
+    def warn_budget(self, exceeded, transformation, conll_tokens, skipped):
+        self.budget_skips += 1
+        if self.quiet:
+            return
+        sentence = getattr(conll_tokens[0], "sentence", None) if conll_tokens else None
+        report = {"limit": exceeded.limit, "value": exceeded.value, "max": exceeded.maximum,
+                  "sentence": self.sentence_label(sentence) if sentence is not None else None,
+                  "line": transformation.line, "skipped": skipped}
+        print("DepEdit WARN: match budget exceeded " + json.dumps(report, sort_keys=True), file=sys.stderr)
+
+    def process_sentence(self, conll_tokens):
+        if self.warmup:
+            self.advance_warmup()
+        if self.max_sentence_time:
+            self.sentence_deadline = timer() + self.max_sentence_time
+        for transformation in self.transformations:
+            # Generated matchers are not profiled, so they are only used after any warm-up
+            compiled = transformation.compiled if not self.warmup else None
+            try:
+                if compiled is not None:
+                    result_sets = compiled[0](self, conll_tokens)
+                else:
+                    result_sets = self.match_transformation(transformation, conll_tokens)
+            except MatchBudgetExceeded as exceeded:
+                if exceeded.limit == "sentence_time":  # Skip this and all remaining rules for the sentence
+                    self.warn_budget(exceeded, transformation, conll_tokens, "sentence")
+                    return
+                self.warn_budget(exceeded, transformation, conll_tokens, "rule")
+                continue
+            if compiled is not None:
+                if result_sets:
+                    self.rule_firings[transformation.line] += 1
+                    if compiled[1](self, result_sets) == "last":
+                        return
+                continue
             self.add_groups(result_sets)
             if result_sets:
+                self.rule_firings[transformation.line] += 1
                 for action in transformation.actions:
                     retval = self.execute_action(result_sets, action)
                     if retval == "last":  # Explicit instruction to cease processing
                         return
 
+    def match_transformation(self, transformation, conll_tokens):
+        """
+        Find all complete matches of a transformation's definitions and relations, without executing its actions
+
+        :param transformation: the Transformation to match
+        :param conll_tokens: list of ParsedToken objects in the sentence
+        :return: list of merged result set dictionaries, empty if the transformation does not apply
+        """
+        self.pairs = 0
+        if self.max_rule_time:
+            self.rule_deadline = timer() + self.max_rule_time
+        node_matches = defaultdict(list)
+        if self.warmup:  # Profile all definitions and criteria to collect unbiased statistics
+            for def_matcher in transformation.definitions:
+                start = timer()
+                for token in conll_tokens:
+                    if not token.is_super_tok and def_matcher.match_profiled(token):
+                        node_matches[def_matcher.def_index].append(
+                            Match(def_matcher.def_index, token, def_matcher.groups))
+                def_matcher.time += timer() - start
+                def_matcher.sentences += 1
+                if not node_matches[def_matcher.def_index]:
+                    def_matcher.empty += 1
+            if any(not node_matches[def_matcher.def_index] for def_matcher in transformation.definitions):
+                return []
+        else:
+            for def_matcher in transformation.eval_definitions:
+                for token in conll_tokens:
+                    if not token.is_super_tok and def_matcher.match(token):
+                        node_matches[def_matcher.def_index].append(
+                            Match(def_matcher.def_index, token, def_matcher.groups))
+                if not node_matches[def_matcher.def_index]:
+                    # A node without candidates can't be part of a complete match, so fail fast
+                    return []
+        result_sets = []
+        for relation in transformation.relations:
+            if not self.matches_relation(node_matches, relation, result_sets):
+                result_sets = []
+        return self.merge_sets(result_sets, len(transformation.definitions), len(transformation.relations))
+
     def matches_relation(self, node_matches, relation, result_sets):
         if not relation:
             return False
@@ -355,8 +903,12 @@ class DepEdit:
             node1 = int(node1.replace("#", ""))
             node2 = int(node2.replace("#", ""))
 
+            budgeted = self.has_budget()
             for matcher1 in node_matches[node1]:
                 tok1 = matcher1.token
+                if budgeted:
+                    self.pairs += len(node_matches[node2])
+                    self.check_budget()
                 for matcher2 in node_matches[node2]:
                     tok2 = matcher2.token
                     if self.test_relation(tok1, tok2, field):
@@ -375,8 +927,12 @@ class DepEdit:
                     node_matches[option].remove(matcher)
         else:
             node1, node2 = [int(node.replace("#", "")) for node in relation.split(operator)]
+            budgeted = self.has_budget()
             for matcher1 in node_matches[node1]:
                 tok1 = matcher1.token
+                if budgeted:
+                    self.pairs += len(node_matches[node2])
+                    self.check_budget()
                 for matcher2 in node_matches[node2]:
                     tok2 = matcher2.token
                     if self.test_relation(tok1, tok2, operator):
@@ -423,7 +979,10 @@ class DepEdit:
 
         solutions = []
         bins = []
+        budgeted = self.has_budget()
         for set_to_merge in sets:
+            if budgeted:
+                self.check_budget(len(bins))
             new_set = {"rels": [], "matchers": []}
             for key in set_to_merge:
                 if key == "rel":
@@ -458,6 +1017,8 @@ class DepEdit:
 
         merged_bins = []
         for solution in solutions:
+            if budgeted:
+                self.check_budget(len(merged_bins))
             self.merge_solutions(solution, merged_bins, rel_count)
         self.prune_merged_bins(merged_bins, rel_count)
         return merged_bins
@@ -649,53 +1210,101 @@ class DepEdit:
             new_transformation = Transformation(transformation_string, user_line_number)
             self.transformations.append(new_transformation)
 
+    @staticmethod
+    def output_fields(tok, tokoffset, columns=10):
+        """
+        Convert a token back to CoNLL column values, restoring sentence-relative IDs and heads
+
+        :param tok: a ParsedToken
+        :param tokoffset: number of tokens preceding this token's sentence in the document
+        :param columns: 10 for CoNLL-U/CoNLL-X, 8 for Malt style input
+        :return: tuple of column strings
+        """
+        if tok.is_super_tok:
+            tok_head_string = tok.head
+            tok_id = tok.id
+        elif tok.head == "0":
+            tok_head_string = "0"
+            tok_id = str(float(tok.id) - tokoffset)
+        else:
+            tok_head_string = str(float(tok.head) - tokoffset)
+            tok_id = str(float(tok.id) - tokoffset)
+        # Only keep decimal ID component for non-0 ellipsis IDs, e.g. 10.1 - those tokens have normal head '_'
+        tok_id = tok_id.replace(".0", "")
+        tok_head_string = tok_head_string.replace(".0", "")
+        if "." in tok_id:
+            tok_head_string = "_"
+        fields = (tok_id, tok.text, tok.lemma, tok.pos, tok.cpos, tok.morph, tok_head_string, tok.func)
+        if columns != 8:
+            fields += (tok.head2, tok.func2)
+        return fields
+
     def serialize_output_tree(self, tokens, tokoffset):
-        output_tree_lines = []
-        for tok in tokens:
-            if tok.is_super_tok:
-                tok_head_string = tok.head
-                tok_id = tok.id
-            elif tok.head == "0":
-                tok_head_string = "0"
-                tok_id = str(float(tok.id) - tokoffset)
+        columns = 8 if self.input_mode == "8col" else 10
+        return ["\t".join(self.output_fields(tok, tokoffset, columns)) for tok in tokens]
+
+    def parse_token(self, cols, tokoffset=0, filename="file"):
+        """
+        Create a ParsedToken from CoNLL column values, offsetting numeric IDs and heads by the tokens preceding
+        its sentence
+
+        :param cols: list of 10 (or 8 for Malt style input) column strings
+        :param tokoffset: number of tokens preceding this token's sentence in the document
+        :param filename: name used in warnings
+        :return: ParsedToken
+        """
+        if "-" in cols[0]:  # potential conllu super-token, just preserve
+            super_tok = True
+            tok_id = cols[0]
+            head_id = cols[6]
+        else:
+            super_tok = False
+            tok_id = str(float(cols[0]) + tokoffset)
+            if cols[6] == "_":
+                if not self.quiet:
+                    print("DepEdit WARN: head not set for token " + tok_id + " in " + filename, file=sys.stderr)
+                head_id = str(0 + tokoffset)
             else:
-                tok_head_string = str(float(tok.head) - tokoffset)
-                tok_id = str(float(tok.id) - tokoffset)
-            # Only keep decimal ID component for non-0 ellipsis IDs, e.g. 10.1 - those tokens have normal head '_'
-            tok_id = tok_id.replace(".0", "")
-            tok_head_string = tok_head_string.replace(".0", "")
-            if "." in tok_id:
-                tok_head_string = "_"
-            fields = (tok_id, tok.text, tok.lemma, tok.pos, tok.cpos, tok.morph, tok_head_string, tok.func)
-            if self.input_mode != "8col":
-                fields += (tok.head2, tok.func2)
-            output_tree_lines.append("\t".join(fields))
-        return output_tree_lines
+                head_id = str(float(cols[6]) + tokoffset)
+        args = (tok_id,) + tuple(cols[1:6]) + (head_id, cols[7])
+        if len(cols) > 8:
+            # Collect token from line; note that head2 is parsed as a string, often "_" for monoplanar trees
+            args += (cols[8], cols[9])
+        else:  # Attempt to read as 8 column Malt input
+            args += (cols[6], cols[7])
+            self.input_mode = "8col"
+        args += (cols[0], [], "mid", super_tok)
+        this_tok = ParsedToken(*args)
+        if cols[0] == "1" and not super_tok:
+            this_tok.position = "first"
+        return this_tok
 
     def make_sent_id(self, sent_id):
         return "# sent_id = " + self.docname + "-" + str(sent_id)
 
-    def run_depedit(self, infile, filename="file", sent_id=False, docname=False):
+    def read_sentences(self, infile, filename="file"):
+        """
+        Generator reading CoNLL input line by line. Comment and blank lines are yielded as strings, and each
+        complete sentence is yielded as a Sentence object carrying its tokens and token offset.
 
-        children = defaultdict(list)
-        child_funcs = defaultdict(list)
-        conll_tokens = [0]
+        :param infile: an iterable of lines, or an unsplit string
+        :param filename: name used in warnings
+        :return: generator of strings and Sentence objects, in input order
+        """
+
+        # Tokens are only kept per sentence, since relations and actions never reach outside it, so memory does not
+        # grow with the length of a stream
+        conll_tokens = []
         self.input_mode = "10col"
-        self.docname = filename
-        tokoffset = supertok_offset = sentlength = supertok_length = 0
-        output_lines = []
-        sentence_lines = []
+        tokoffset = sentlength = 0
         current_sentence = Sentence(sent_num=1)
 
-        def _process_sentence():
+        def _finish_sentence():
             current_sentence.length = sentlength
             conll_tokens[-1].position = "last"
-            sentence_tokens = conll_tokens[tokoffset + supertok_offset + 1:]
-            self.process_sentence(sentence_tokens)
-            transformed = current_sentence.print_annos() + self.serialize_output_tree(sentence_tokens, tokoffset)
-            output_lines.extend(transformed)
-            if sent_id:
-                output_lines.append(self.make_sent_id(current_sentence.sent_num))
+            current_sentence.tokens = conll_tokens
+            current_sentence.tokoffset = tokoffset
+            return current_sentence
 
         # Check if DepEdit has been fed an unsplit string programmatically
         if isinstance(infile, str):
@@ -704,60 +1313,596 @@ class DepEdit:
         for myline in infile:
             myline = myline.strip()
             if sentlength and "\t" not in myline:
-                _process_sentence()
-                sentence_lines = []
+                yield _finish_sentence()
                 current_sentence = Sentence(sent_num=current_sentence.sent_num + 1)
+                conll_tokens = []
                 tokoffset += sentlength
-                supertok_offset += supertok_length
-                sentlength = supertok_length = 0
+                sentlength = 0
             if myline.startswith("#"):  # Preserve comment lines
-                output_lines.append(myline)
+                m = re.match(r'#\s*sent_id\s*=\s*(.*)', myline)
+                if m is not None:
+                    current_sentence.sent_id = m.group(1)
+                yield myline
             elif not myline:
-                output_lines.append("")
+                yield ""
             elif myline.find("\t") > 0:  # Only process lines that contain tabs (i.e. conll tokens)
-                sentence_lines.append(myline)
-                cols = myline.split("\t")
-                if "-" in cols[0]:  # potential conllu super-token, just preserve
-                    super_tok = True
-                    tok_id = cols[0]
-                    head_id = cols[6]
-                else:
-                    super_tok = False
-                    tok_id = str(float(cols[0]) + tokoffset)
-                    if cols[6] == "_":
-                        if not self.quiet:
-                            print("DepEdit WARN: head not set for token " + tok_id + " in " + filename, file=sys.stderr)
-                        head_id = str(0 + tokoffset)
-                    else:
-                        head_id = str(float(cols[6]) + tokoffset)
-                args = (tok_id,) + tuple(cols[1:6]) + (head_id, cols[7])
-                if len(cols) > 8:
-                    # Collect token from line; note that head2 is parsed as a string, often "_" for monoplanar trees
-                    args += (cols[8], cols[9])
-                else:  # Attempt to read as 8 column Malt input
-                    args += (cols[6], cols[7])
-                    self.input_mode = "8col"
-                args += (cols[0], [], "mid", super_tok)
-                this_tok = ParsedToken(*args)
-                if cols[0] == "1" and not super_tok:
-                    this_tok.position = "first"
+                this_tok = self.parse_token(myline.split("\t"), tokoffset, filename)
                 this_tok.sentence = current_sentence
                 conll_tokens.append(this_tok)
-                if super_tok:
-                    supertok_length += 1
-                else:
+                if not this_tok.is_super_tok:
                     sentlength += 1
-                    children[str(float(head_id) + tokoffset)].append(tok_id)
-                    child_funcs[(float(head_id) + tokoffset)].append(cols[7])
 
         if sentlength:  # Possible final sentence without trailing new line
-            _process_sentence()
+            yield _finish_sentence()
+
+    def iter_output(self, infile, filename="file", sent_id=False, docname=False):
+        """
+        Generator applying the transformations to the input and yielding output lines as soon as each sentence is done
+
+        :return: generator of output lines, without line breaks
+        """
 
+        self.docname = filename
         if docname:
-            newdoc = '# newdoc id = ' + self.docname
-            output_lines.insert(0, newdoc)
+            yield '# newdoc id = ' + self.docname
+
+        for item in self.read_sentences(infile, filename):
+            if isinstance(item, Sentence):
+                self.process_sentence(item.tokens)
+                self.sentence_count += 1
+                self.token_count += item.length
+                if self.metrics is not None:
+                    self.metrics.update()
+                for line in item.print_annos() + self.serialize_output_tree(item.tokens, item.tokoffset):
+                    yield line
+                if sent_id:
+                    yield self.make_sent_id(item.sent_num)
+            else:
+                yield item
+
+    def run_depedit(self, infile, filename="file", sent_id=False, docname=False):
+        return "\n".join(self.iter_output(infile, filename, sent_id=sent_id, docname=docname))
+
+    def transform_sentence(self, tokens, in_place=False, annotations=None):
+        """
+        Apply the transformations to one sentence given as Python objects, skipping conversion to and from CoNLL text.
+
+        Tokens may be ParsedToken objects, which are used as they are; tuples or lists of column values in CoNLL
+        order (10 columns, or 8 for Malt style input); dictionaries keyed by ParsedToken field names or their CoNLL-U
+        aliases (e.g. 'form', 'upostag', 'deprel'); or other objects with ParsedToken attribute names. Values may be
+        ints or None, and missing values are read as '_' (or '0' for heads) for matching. Only values changed by the
+        transformations are written back, so changed int IDs and heads remain ints and missing fields stay missing.
+
+        :param tokens: list of tokens for one sentence
+        :param in_place: modify the given tokens, and replace tuples in the given token list, rather than returning
+            copies
+        :param annotations: optional dictionary to receive sentence annotations added by #S: actions
+        :return: the transformed tokens, in the same format as the input
+        """
+
+        sentence = Sentence()
+        records = []
+        for token in tokens:
+            if isinstance(token, ParsedToken):
+                parsed = token if in_place else copy(token)
+                before = None
+            else:
+                if isinstance(token, (tuple, list)):
+                    values = list(token)
+                    if len(values) == 8:  # Malt style input, see parse_token
+                        values += values[6:8]
+                elif isinstance(token, dict):
+                    values = [token.get(field if field in token else FIELD_ALIASES.get(field, field))
+                              for field in FIELDS]
+                else:
+                    values = [getattr(token, field, None) for field in FIELDS]
+                cols = ["_" if value is None else value if isinstance(value, string_types) else str(value)
+                        for value in values]
+                tok_id = cols[0]
+                if cols[6] == "_" and "-" not in tok_id:
+                    cols[6] = "0"  # Unset heads are matched as attached to the root, but not written back
+                parsed = ParsedToken(tok_id, cols[1], cols[2], cols[3], cols[4], cols[5], cols[6], cols[7], cols[8],
+                                     cols[9], tok_id, [], "first" if tok_id == "1" else "mid", "-" in tok_id)
+                before = tuple(cols)
+            parsed.sentence = sentence
+            if not parsed.is_super_tok:
+                sentence.length += 1
+            sentence.tokens.append(parsed)
+            records.append((token, parsed, before))
+        if records and records[-1][2] is not None:
+            sentence.tokens[-1].position = "last"
+
+        self.process_sentence(sentence.tokens)
+        self.sentence_count += 1
+        self.token_count += sentence.length
+        if annotations is not None:
+            annotations.update(sentence.annotations)
+
+        def _restore(original, value):
+            if isinstance(original, int) and not isinstance(original, bool) and value.lstrip("-").isdigit():
+                return int(value)
+            return value
+
+        output = tokens if in_place else []
+        for i, (token, parsed, before) in enumerate(records):
+            if before is None:  # ParsedToken, already modified directly
+                if not in_place:
+                    output.append(parsed)
+                continue
+            after = get_fields(parsed)
+            if after == before:  # Nothing changed, so nothing to write back
+                if not in_place:
+                    output.append(token if isinstance(token, tuple) else copy(token))
+                continue
+            changed = [(index, value) for index, value in enumerate(after) if value != before[index]]
+            if isinstance(token, (tuple, list)):
+                values = list(token)
+                for index, value in changed:
+                    if index < len(values):
+                        values[index] = _restore(values[index], value)
+                if isinstance(token, list) and in_place:
+                    token[:] = values
+                elif in_place:
+                    tokens[i] = tuple(values)
+                else:
+                    output.append(type(token)(values))
+                continue
+            if not in_place:
+                token = copy(token)
+                output.append(token)
+            for index, value in changed:
+                field = FIELDS[index]
+                if isinstance(token, dict):
+                    key = field if field in token else FIELD_ALIASES.get(field, field)
+                    token[key] = _restore(token.get(key), value)
+                else:
+                    setattr(token, field, _restore(getattr(token, field, None), value))
+        return output
+
+    def transform_sentences(self, sentences, in_place=False):
+        """
+        Apply transform_sentence to each of a list of sentences
+
+        :param sentences: iterable of token lists
+        :param in_place: modify the given tokens rather than returning copies
+        :return: list of transformed sentences
+        """
+        return [self.transform_sentence(tokens, in_place=in_place) for tokens in sentences]
 
-        return "\n".join(output_lines)
+    def run_depedit_stream(self, infile, outfile, filename="file", sent_id=False, docname=False, queue_size=64,
+                           chunk_lines=2000, flush=True):
+        """
+        Pipelined version of run_depedit for use as a filter: a reader thread splits the input into sentence blocks,
+        the calling thread parses and transforms them, and a writer thread writes and flushes the output, with bounded
+        queues between the stages. Produces the same text as run_depedit.
+
+        :param infile: an iterable of input lines, e.g. sys.stdin
+        :param outfile: a file-like object to write output text to
+        :param queue_size: maximum number of blocks waiting between stages
+        :param chunk_lines: maximum number of output lines handed to the writer at once
+        :param flush: flush output whenever the writer catches up, to minimize latency; turn off for files, where
+                      frequent flushes only cost time and compression
+        :return: void
+        """
+        from threading import Thread
+
+        in_queue = queue.Queue(queue_size)
+        out_queue = queue.Queue(queue_size)
+        errors = []
+
+        def _read():
+            try:
+                block = []
+                for line in infile:
+                    block.append(line)
+                    if not line.strip():  # Sentence boundary
+                        in_queue.put(block)
+                        block = []
+                if block:
+                    in_queue.put(block)
+            except Exception as e:
+                errors.append(e)
+            in_queue.put(None)
+
+        def _write():
+            try:
+                while True:
+                    chunk = out_queue.get()
+                    if chunk is None:
+                        break
+                    outfile.write(chunk)
+                    if flush and out_queue.empty():  # Flush whenever the writer catches up, to minimize latency
+                        outfile.flush()
+                outfile.flush()
+            except Exception as e:
+                errors.append(e)
+                while out_queue.get() is not None:  # Keep draining so the worker does not block until it stops
+                    pass
+
+        pending = []
+        first = [True]
+
+        def _hand_over():
+            if errors:  # Output can no longer be written or input read, so stop transforming
+                raise errors[0]
+            if pending:
+                out_queue.put(("" if first[0] else "\n") + "\n".join(pending))
+                first[0] = False
+                del pending[:]
+
+        def _queued_lines():
+            while True:
+                if in_queue.empty() or errors:  # About to wait for input, so pass on what is done so far
+                    _hand_over()
+                block = in_queue.get()
+                if block is None:
+                    return
+                for line in block:
+                    yield line
+
+        reader = Thread(target=_read)
+        writer = Thread(target=_write)
+        reader.daemon = writer.daemon = True
+        reader.start()
+        writer.start()
+        try:
+            for line in self.iter_output(_queued_lines(), filename, sent_id=sent_id, docname=docname):
+                pending.append(line)
+                if len(pending) >= chunk_lines:
+                    _hand_over()
+            _hand_over()
+        finally:
+            out_queue.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
+
+    def run_query(self, infile, query, filename="file", limit=0, max_ids=10):
+        """
+        Match-only counterpart to run_depedit: counts sentences matching a query without executing actions or
+        serializing output.
+
+        :param infile: an iterable of lines, or an unsplit string
+        :param query: a Transformation created with query=True, or a query string (definitions, tab, relations)
+        :param filename: document name used for sentences without a sent_id comment
+        :param limit: stop reading after this many matching sentences (0 for no limit)
+        :param max_ids: how many matching sentence IDs to collect
+        :return: dictionary with counts of scanned 'sentences', 'matched_sentences', 'matches' and list of 'ids';
+            with a limit, 'hits' also lists (sentences scanned, matches) for each matching sentence, so that results
+            from several files can be cut off at the limit exactly
+        """
+
+        if not isinstance(query, Transformation):
+            query = Transformation(query, "query", query=True)
+            report = query.validate()
+            if report:
+                print("Depedit says: error in query\n\n" + report, file=sys.stderr)
+                sys.exit()
+        self.docname = filename
+        stats = {"sentences": 0, "matched_sentences": 0, "matches": 0, "ids": [], "hits": []}
+
+        for item in self.read_sentences(infile, filename):
+            if not isinstance(item, Sentence):
+                continue
+            stats["sentences"] += 1
+            if self.max_sentence_time:
+                self.sentence_deadline = timer() + self.max_sentence_time
+            try:
+                result_sets = self.match_transformation(query, item.tokens)
+            except MatchBudgetExceeded as exceeded:
+                self.warn_budget(exceeded, query, item.tokens, "sentence")
+                continue
+            if result_sets:
+                stats["matched_sentences"] += 1
+                stats["matches"] += len(result_sets)
+                if len(stats["ids"]) < max_ids:
+                    stats["ids"].append(self.sentence_label(item))
+                if limit:
+                    stats["hits"].append((stats["sentences"], len(result_sets)))
+                    if stats["matched_sentences"] >= limit:
+                        break
+
+        return stats
+
+
+class Metrics:
+    """
+    Throughput metrics for batch runs, written as JSON lines or, for files ending in .prom, in the Prometheus text
+    exposition format for a node exporter textfile collector. Per-file records are written as each file is done, and
+    running totals at most every `interval` seconds during long files. The Prometheus file only holds run totals and
+    gauges for the most recent and slowest file, so its size and series count stay constant; file names and the full
+    per-file history are only kept in JSON lines output.
+    """
+
+    def __init__(self, depedit, path, interval=10.0):
+        self.depedit = depedit
+        self.path = path
+        self.prometheus = path.endswith(".prom")
+        self.interval = interval
+        self.start = self.last_write = timer()
+        self.file_count = 0
+        self.last_file = self.slowest_file = None
+        self.file_name = None
+        self.file_start = 0.0
+        self.file_counts = (0, 0, 0)
+        self.out = None if self.prometheus else io_open(path, "w", encoding="utf8")
+
+    def counts(self):
+        return self.depedit.token_count, self.depedit.sentence_count, sum(self.depedit.rule_firings.values())
+
+    @staticmethod
+    def peak_memory():
+        """
+        :return: peak resident memory of this process in bytes, or None where the resource module is unavailable
+        """
+        try:
+            import resource
+        except ImportError:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # Linux reports kilobytes
+
+    def start_file(self, filename):
+        self.file_name = filename
+        self.file_start = timer()
+        self.file_counts = self.counts()
+
+    def end_file(self):
+        elapsed = timer() - self.file_start
+        tokens, sentences, firings = (now - before for now, before in zip(self.counts(), self.file_counts))
+        record = {"type": "file", "file": self.file_name, "tokens": tokens, "sentences": sentences,
+                  "elapsed": round(elapsed, 6), "tokens_per_sec": round(tokens / elapsed, 2) if elapsed else 0.0,
+                  "rule_firings": firings, "peak_memory": self.peak_memory()}
+        self.file_count += 1
+        self.last_file = record
+        if self.slowest_file is None or record["tokens_per_sec"] < self.slowest_file["tokens_per_sec"]:
+            self.slowest_file = record
+        if not self.prometheus:
+            self.out.write(json.dumps(record, sort_keys=True) + "\n")
+        self.write_totals()
+
+    def update(self):
+        if timer() - self.last_write >= self.interval:
+            self.write_totals()
+
+    def totals(self):
+        elapsed = timer() - self.start
+        tokens, sentences, firings = self.counts()
+        return {"type": "totals", "files": self.file_count, "tokens": tokens, "sentences": sentences,
+                "elapsed": round(elapsed, 6), "tokens_per_sec": round(tokens / elapsed, 2) if elapsed else 0.0,
+                "rule_firings": firings, "rule_firings_by_line": dict((str(line), count) for line, count in
+                                                                      iteritems(self.depedit.rule_firings)),
+                "peak_memory": self.peak_memory()}
+
+    def write_totals(self):
+        self.last_write = timer()
+        totals = self.totals()
+        if not self.prometheus:
+            self.out.write(json.dumps(totals, sort_keys=True) + "\n")
+            self.out.flush()
+            return
+
+        def _escape(label):
+            return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines = []
+        for name, kind, description, value in [
+                ("depedit_files_total", "counter", "Files processed", totals["files"]),
+                ("depedit_tokens_total", "counter", "Tokens processed", totals["tokens"]),
+                ("depedit_sentences_total", "counter", "Sentences processed", totals["sentences"]),
+                ("depedit_elapsed_seconds", "gauge", "Seconds since the run started", totals["elapsed"]),
+                ("depedit_tokens_per_second", "gauge", "Average tokens per second in this run",
+                 totals["tokens_per_sec"]),
+                ("depedit_peak_memory_bytes", "gauge", "Peak resident memory", totals["peak_memory"])]:
+            if value is not None:
+                lines += ["# HELP " + name + " " + description, "# TYPE " + name + " " + kind,
+                          name + " " + str(value)]
+        lines += ["# HELP depedit_rule_firings_total Sentences each rule applied to, by configuration line",
+                  "# TYPE depedit_rule_firings_total counter"]
+        for line, count in sorted(totals["rule_firings_by_line"].items()):
+            lines.append('depedit_rule_firings_total{line="' + _escape(line) + '"} ' + str(count))
+        # One series per label value, so that the number of series stays fixed however many files are processed
+        for name, key, description in [("depedit_file_tokens", "tokens", "Tokens in the file"),
+                                       ("depedit_file_elapsed_seconds", "elapsed", "Seconds spent on the file"),
+                                       ("depedit_file_tokens_per_second", "tokens_per_sec", "Tokens per second for "
+                                                                                            "the file")]:
+            lines += ["# HELP " + name + " " + description + ", for the most recent and the slowest file so far",
+                      "# TYPE " + name + " gauge"]
+            for which, record in [("last", self.last_file), ("slowest", self.slowest_file)]:
+                if record is not None:
+                    lines.append(name + '{which="' + which + '"} ' + str(record[key]))
+        # Write to a temporary file and rename, so the collector never reads a partial file
+        with io_open(self.path + ".tmp", "w", encoding="utf8") as f:
+            f.write("\n".join(lines) + "\n")
+        if hasattr(os, "replace"):
+            os.replace(self.path + ".tmp", self.path)
+        else:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(self.path + ".tmp", self.path)
+
+    def close(self):
+        self.write_totals()
+        if self.out is not None:
+            self.out.close()
+
+
+BUFFER_SIZE = 1024 * 1024
+COMPRESSION_EXTENSIONS = {"gz": "gzip", "bz2": "bz2", "xz": "lzma"}
+COMPRESSION_MAGIC = [(b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "lzma")]
+
+
+def split_compression(filename):
+    """
+    Separate a compression extension such as .gz from a file name
+
+    :param filename: file name, e.g. 'doc.conllu.gz'
+    :return: tuple of the name without compression extension and the compression extension, e.g. ('doc.conllu', 'gz')
+    """
+    if "." in filename:
+        extension = filename[filename.rfind(".") + 1:]
+        if extension.lower() in COMPRESSION_EXTENSIONS:
+            return filename[:filename.rfind(".")], extension.lower()
+    return filename, ""
+
+
+class DecompressedReader(TextIOWrapper):
+    """
+    Text reader for a decompressor, which also closes the file the compressed data is read from
+    """
+    def __init__(self, compressed, source):
+        TextIOWrapper.__init__(self, compressed, encoding="utf8")
+        self.source = source
+
+    def close(self):
+        try:
+            TextIOWrapper.close(self)
+        finally:
+            self.source.close()
+
+
+def open_input(filename):
+    """
+    Open a file or STDIN ('-') for reading UTF-8 text with a large buffer, transparently decompressing gzip, bzip2
+    and xz input, which is recognized by its leading magic bytes. The input is opened only once, so pipes and FIFOs
+    work too, and reads return whatever is available rather than waiting for a full buffer.
+
+    :param filename: path to the input file, or '-' for STDIN
+    :return: text file object
+    """
+    if filename == "-":
+        raw = io_open(sys.stdin.fileno(), "rb", buffering=BUFFER_SIZE, closefd=False)
+    else:
+        raw = io_open(filename, "rb", buffering=BUFFER_SIZE)
+    head = raw.peek(6)[:6]  # Look at the magic bytes without consuming them
+    module_name = None
+    for magic, name in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            module_name = name
+    if module_name is None:
+        return TextIOWrapper(raw, encoding="utf8")
+    module = __import__(module_name)
+    return DecompressedReader(module.open(raw, "rb"), raw)
+
+
+def open_output(filename, compression=""):
+    """
+    Open a file for writing UTF-8 text with a large buffer, optionally compressed
+
+    :param filename: path to the output file
+    :param compression: '' for plain text, or a compression extension: 'gz', 'bz2' or 'xz'
+    :return: text file object
+    """
+    if not compression:
+        return io_open(filename, "w", encoding="utf8", newline="\n", buffering=BUFFER_SIZE)
+    module = __import__(COMPRESSION_EXTENSIONS[compression])
+    if compression == "gz":
+        compressed = module.open(filename, "wb", compresslevel=6)
+    else:
+        compressed = module.open(filename, "wb")
+    # Buffer in front of the compressor, since each write or flush that reaches it costs extra output and time
+    return TextIOWrapper(BufferedWriter(compressed, BUFFER_SIZE), encoding="utf8", newline="\n")
+
+
+def output_name(filename, options):
+    """
+    Name the output file for a batch input file, adding '.depedit' or another infix from options before the
+    extension, and a compression extension if output is compressed
+
+    :param filename: path to the input file
+    :param options: command line options with outdir, infix, extension and compress
+    :return: path to the output file
+    """
+    outdir = options.outdir
+    if outdir and not outdir.endswith(os.sep):
+        outdir += os.sep
+    basename = split_compression(os.path.basename(filename))[0]
+    outname = outdir + basename
+    if "." in basename:
+        extension = outname[outname.rfind(".") + 1:]
+        if options.extension:
+            extension = options.extension
+        outname = outname[:outname.rfind(".")]
+        outname += options.infix + "." + extension
+    else:
+        outname += options.infix + "." + options.extension if options.extension else options.infix
+    if options.compress:
+        outname += "." + options.compress
+    return outname
+
+
+def query_file(args):
+    """
+    Run a query on a single file; module level so it can be dispatched to worker processes
+
+    :param args: tuple of (filename, query string, limit, max_ids, quiet)
+    :return: tuple of filename and the statistics dictionary from DepEdit.run_query
+    """
+    filename, query, limit, max_ids, quiet = args
+    depedit = DepEdit()
+    depedit.quiet = quiet
+    basename = os.path.basename(filename)
+    basename = split_compression(basename)[0]
+    with open_input(filename) as infile:
+        stats = depedit.run_query(infile, query, basename[:basename.rfind(".")] if "." in basename else basename,
+                                  limit=limit, max_ids=max_ids)
+    return filename, stats
+
+
+def query_main(options):
+    query = options.query
+    if "\t" not in query:  # Allow an escaped tab, since shells do not expand \t in quoted arguments
+        query = query.replace("\\t", "\t")
+    # Validate once up front rather than in every worker
+    report = Transformation(query, "query", query=True).validate()
+    if report:
+        print("Depedit says: error in query\n\n" + report, file=sys.stderr)
+        sys.exit()
+
+    files = sorted(glob(options.file))
+    totals = {"sentences": 0, "matched_sentences": 0, "matches": 0, "ids": []}
+    limit_reached = False
+
+    def _remaining():
+        return options.limit - totals["matched_sentences"] if options.limit else 0
+
+    def _collect(results):
+        for filename, stats in results:
+            remaining = _remaining()
+            if options.limit and stats["matched_sentences"] > remaining:
+                # Parallel workers each search up to the full limit, so cut this file off where the total is reached
+                kept = stats["hits"][:remaining]
+                stats["sentences"] = kept[-1][0] if kept else 0
+                stats["matched_sentences"] = len(kept)
+                stats["matches"] = sum(matches for scanned, matches in kept)
+                stats["ids"] = stats["ids"][:remaining]
+            if len(files) > 1:
+                print("\t".join([filename, str(stats["sentences"]), str(stats["matched_sentences"]),
+                                 str(stats["matches"])]))
+            for key in ["sentences", "matched_sentences", "matches"]:
+                totals[key] += stats[key]
+            totals["ids"] += stats["ids"][:options.ids - len(totals["ids"])]
+            if options.limit and totals["matched_sentences"] >= options.limit:
+                return True
+        return False
+
+    if options.jobs > 1 and len(files) > 1:
+        from multiprocessing import Pool
+        pool = Pool(options.jobs)
+        try:
+            jobs = [(filename, query, options.limit, options.ids, options.quiet) for filename in files]
+            limit_reached = _collect(pool.imap(query_file, jobs))
+        finally:
+            pool.terminate()
+    else:
+        # Jobs are created lazily, so that each file only searches for the matches still needed
+        limit_reached = _collect(query_file((filename, query, _remaining(), options.ids, options.quiet))
+                                 for filename in files)
+
+    print("Matched sentences: " + str(totals["matched_sentences"]) + " (" + str(totals["matches"]) + " matches) in " +
+          str(totals["sentences"]) + " sentences" + (" (stopped at limit)" if limit_reached else ""))
+    for sent_id in totals["ids"]:
+        print(sent_id)
 
 
 def main(options):
@@ -769,52 +1914,121 @@ def main(options):
         print("\nConfiguration file not found (specify with -c or use the default 'config.ini')", file=sys.stderr)
         sys.exit()
     depedit = DepEdit(config_file=config_file, options=options)
+    if options.stats and os.path.isfile(options.stats):
+        depedit.read_stats(options.stats)
+    if options.compile:
+        depedit.compile_transformations(options.compile_cache or os.path.join(os.path.expanduser("~"), ".cache",
+                                                                              "depedit"))
     if sys.platform == "win32":  # Print \n new lines in Windows
-        import os
         import msvcrt
         msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
-    files = glob(options.file)
+    if options.metrics:
+        depedit.metrics = Metrics(depedit, options.metrics, options.metrics_interval)
+    files = ["-"] if options.file == "-" else glob(options.file)
+    if len(files) > 1:
+        # Refuse up front if two inputs would be written to the same file, e.g. doc.conllu and doc.conllu.gz
+        outnames = {}
+        for filename in files:
+            outname = output_name(filename, options)
+            if outname in outnames:
+                print("\nDepedit says: input files " + outnames[outname] + " and " + filename +
+                      " would both be written to " + outname + "; rename one of them or process them separately",
+                      file=sys.stderr)
+                sys.exit()
+            outnames[outname] = filename
     for filename in files:
-        infile = io_open(filename, encoding="utf8")
-        basename = os.path.basename(filename)
-        docname = basename[:basename.rfind(".")] if options.docname or options.sent_id else filename
-        output_trees = depedit.run_depedit(infile, docname, sent_id=options.sent_id, docname=options.docname)
-        if len(files) == 1:
-            # Single file being processed, just print to STDOUT
-            print(output_trees.encode("utf-8") if sys.version_info[0] < 3 else output_trees, end="")
+        if depedit.metrics is not None:
+            depedit.metrics.start_file(filename)
+        if filename == "-":  # Act as a filter on STDIN
+            basename = docname = "stdin"
         else:
-            # Multiple files, add '.depedit' or other infix from options before extension and write to file
-            if options.outdir:
-                if not options.outdir.endswith(os.sep):
-                    options.outdir += os.sep
-            outname = options.outdir + basename
-            if "." in filename:
-                extension = outname[outname.rfind(".") + 1:]
-                if options.extension:
-                    extension = options.extension
-                outname = outname[:outname.rfind(".")]
-                outname += options.infix + "." + extension
-            else:
-                outname += options.infix + "." + options.extension if options.extension else options.infix
-            if sys.version_info[0] < 3:
-                with open(outname, 'wb') as f:
-                    f.write(output_trees.encode("utf-8"))
+            basename = split_compression(os.path.basename(filename))[0]
+            docname = basename[:basename.rfind(".")] if options.docname or options.sent_id else filename
+        with open_input(filename) as infile:  # Compressed input is decompressed on the fly
+            if len(files) == 1:
+                # Single file being processed, stream to STDOUT as sentences are completed
+                stdout = io_open(sys.stdout.fileno(), "w", encoding="utf8", newline="\n", closefd=False)
+                try:
+                    depedit.run_depedit_stream(infile, stdout, docname, sent_id=options.sent_id,
+                                               docname=options.docname)
+                except IOError as e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                    # The reader went away (e.g. piped into head), so stop quietly like other Unix filters.
+                    # Point STDOUT at devnull so flushing on exit does not raise again.
+                    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                    sys.exit(1)
             else:
-                with open(outname, 'w', encoding="utf8") as f:
-                    f.write(output_trees.encode("utf-8"))
+                # Stream to the output file, so that compression runs alongside the transformations
+                with open_output(output_name(filename, options), options.compress) as outfile:
+                    depedit.run_depedit_stream(infile, outfile, docname, sent_id=options.sent_id,
+                                               docname=options.docname, flush=False)
+        if depedit.metrics is not None:
+            depedit.metrics.end_file()
+    if depedit.metrics is not None:
+        depedit.metrics.close()
+    if options.stats:
+        depedit.write_stats(options.stats)
 
 
 if __name__ == "__main__":
     depedit_version = "DepEdit V" + __version__
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        parser = argparse.ArgumentParser(prog="depedit query",
+                                         description="Count sentences matching node definitions and relations, "
+                                                     "without applying any actions")
+        parser.add_argument('query', action="store",
+                            help="Definitions and optional relations separated by a tab or '\\t', "
+                                 "e.g. \"pos=/WP/;func=/root/\\t#2>#1\"")
+        parser.add_argument('file', action="store",
+                            help="Input single file name or glob pattern to process a batch (e.g. *.conll10)")
+        parser.add_argument('-n', '--ids', action="store", dest="ids", type=int, default=10,
+                            help="Number of matching sentence IDs to list (default: 10)")
+        parser.add_argument('-l', '--limit', action="store", dest="limit", type=int, default=0,
+                            help="Stop after this many matching sentences (default: 0, no limit)")
+        parser.add_argument('-j', '--jobs', action="store", dest="jobs", type=int, default=1,
+                            help="Number of processes to query multiple files in parallel (default: 1)")
+        parser.add_argument('-q', '--quiet', action="store_true", dest="quiet",
+                            help="Do not output warnings and messages")
+        query_main(parser.parse_args(sys.argv[2:]))
+        sys.exit()
     parser = argparse.ArgumentParser()
     parser.add_argument('file', action="store",
-                        help="Input single file name or glob pattern to process a batch (e.g. *.conll10)")
+                        help="Input single file name, glob pattern to process a batch (e.g. *.conll10), or '-' to "
+                             "read from STDIN; gzip, bzip2 and xz compressed input is detected automatically")
     parser.add_argument('-c', '--config', action="store", dest="config", default="config.ini",
                         help="Configuration file defining transformation")
     parser.add_argument('-d', '--docname', action="store_true", dest="docname",
                         help="Begin output with # newdoc id =...")
     parser.add_argument('-s', '--sent_id', action="store_true", dest="sent_id", help="Add running sentence ID comments")
     parser.add_argument('-q', '--quiet', action="store_true", dest="quiet", help="Do not output warnings and messages")
+    group = parser.add_argument_group('Performance options')
+    group.add_argument('--warmup', action="store", dest="warmup", type=int, default=0,
+                       help="Profile the first N sentences, then reorder node definitions and criteria to fail fast "
+                            "(default: 0, keep configuration order)")
+    group.add_argument('--stats', action="store", dest="stats", default="",
+                       help="JSON file to read selectivity statistics from if it exists, and to save them to after "
+                            "the run")
+    group.add_argument('--compile', action="store_true", dest="compile",
+                       help="Generate and compile specialized Python code for each rule instead of interpreting rules")
+    group.add_argument('--compile_cache', action="store", dest="compile_cache", default="",
+                       help="Directory to save generated rule code to and reuse it from (default: ~/.cache/depedit)")
+    group.add_argument('--metrics', action="store", dest="metrics", default="",
+                       help="File to write throughput metrics to, as JSON lines or, if the name ends in .prom, in "
+                            "Prometheus text format")
+    group.add_argument('--metrics_interval', action="store", dest="metrics_interval", type=float, default=10.0,
+                       help="Seconds between running total updates in the metrics file (default: 10)")
+    group = parser.add_argument_group('Match budget options (rules exceeding a limit on a sentence are skipped)')
+    group.add_argument('--max_pairs', action="store", dest="max_pairs", type=int, default=0,
+                       help="Maximum candidate node pairs tested per rule and sentence (default: 0, no limit)")
+    group.add_argument('--max_bins', action="store", dest="max_bins", type=int, default=0,
+                       help="Maximum partial solutions held while merging relations per rule and sentence "
+                            "(default: 0, no limit)")
+    group.add_argument('--max_rule_time', action="store", dest="max_rule_time", type=float, default=0.0,
+                       help="Maximum seconds spent matching one rule on one sentence (default: 0, no limit)")
+    group.add_argument('--max_sentence_time', action="store", dest="max_sentence_time", type=float, default=0.0,
+                       help="Maximum seconds spent matching all rules on one sentence; remaining rules are skipped "
+                            "(default: 0, no limit)")
     group = parser.add_argument_group('Batch mode options')
     group.add_argument('-o', '--outdir', action="store", dest="outdir", default="",
                        help="Output directory in batch mode")
@@ -822,5 +2036,8 @@ if __name__ == "__main__":
                        help="Extension for output files in batch mode")
     group.add_argument('-i', '--infix', action="store", dest="infix", default=".depedit",
                        help="Infix to denote edited files in batch mode (default: .depedit)")
+    group.add_argument('-z', '--compress', action="store", dest="compress", default="",
+                       choices=sorted(COMPRESSION_EXTENSIONS),
+                       help="Compress output files in batch mode, adding the corresponding extension (e.g. .gz)")
     parser.add_argument('--version', action='version', version=depedit_version)
     main(parser.parse_args())
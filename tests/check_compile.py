@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Check that compiled transformations behave exactly like the interpreter
+
+Random sentences are edited by random rules four ways: interpreted, compiled, compiled through a source cache
+directory, and compiled after a warm-up which reorders evaluation and regenerates the code. Any difference in output
+is reported with the seed, rules and outputs needed to reproduce it.
+
+Usage: python tests/check_compile.py [-s SEED] [-n TRIALS]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from depedit.depedit import DepEdit
+
+POS = ["NN", "VB", "DT", "JJ", "IN", "WP"]
+FUNCS = ["nsubj", "obj", "det", "amod", "root", "case"]
+WORDS = ["a", "the", "dog", "cat", "what", "?", "run", "big"]
+VALUES = ["NN", "(N)N", "(.).*", ".*", "(V|N).*", "dog", "th(e)", "x", "(a)", "\\?"] + POS + FUNCS + WORDS[:5]
+MODES = ["interpreted", "compiled", "cached", "warm-up"]
+
+
+def random_sentence(rand, length):
+    lines = []
+    for i in range(1, length + 1):
+        head = 0 if i == 1 else rand.randint(1, length) if rand.random() < 0.5 else 1
+        if head == i:
+            head = 0
+        lines.append("\t".join([str(i), rand.choice(WORDS), rand.choice(WORDS), rand.choice(POS), rand.choice(POS),
+                                "_", str(head), rand.choice(FUNCS), "_", "_"]))
+    return "\n".join(lines)
+
+
+def random_criterion(rand):
+    field = rand.choice(["text", "pos", "cpos", "lemma", "func", "form", "upostag", "position"])
+    if field == "position":
+        return "position=/" + rand.choice(["first", "last", "mid"]) + "/"
+    return field + ("!=" if rand.random() < 0.15 else "=") + "/" + rand.choice(VALUES) + "/"
+
+
+def random_rule(rand):
+    nodes = rand.randint(1, 3)
+    criteria = [[random_criterion(rand) for _ in range(rand.randint(1, 3))] for _ in range(nodes)]
+    definitions = ";".join("&".join(node_criteria) for node_criteria in criteria)
+    relations = []
+    for i in range(2, nodes + 1):
+        a, b = rand.sample(range(1, i + 1), 2) if rand.random() < 0.5 else (rand.randint(1, i - 1), i)
+        if rand.random() < 0.85:
+            relations.append("#" + str(a) + rand.choice([">", ".", ".*", ".1,3", ".2"]) + "#" + str(b))
+        else:
+            relations.append("#" + str(a) + ":" + rand.choice(["pos", "lemma", "func"]) + "==#" + str(b))
+    if nodes > 1 and rand.random() < 0.3:
+        relations.append("#1>#" + str(nodes))
+    # Only groups in positive criteria can be referred to as $1, $2 in actions
+    groups = sum(criterion.count("(") for node_criteria in criteria for criterion in node_criteria
+                 if "!=" not in criterion)
+    actions = []
+    for _ in range(rand.randint(1, 3)):
+        kind = rand.random()
+        node = "#" + str(rand.randint(1, nodes))
+        if kind < 0.3:
+            actions.append(node + ":func=" + rand.choice(FUNCS))
+        elif kind < 0.5 and groups >= 2:
+            actions.append(node + ":lemma=$1-$2L")
+        elif kind < 0.6:
+            actions.append("#S:type=x" + str(rand.randint(0, 9)))
+        elif kind < 0.7:
+            actions.append("last")
+        elif kind < 0.9 and nodes > 1:
+            actions.append(node + ">#" + str(rand.randint(1, nodes)))
+        elif groups >= 1:
+            actions.append(node + ":pos=$1U")
+    if not actions:
+        actions.append(node + ":func=dep")
+    return "\t".join([definitions, ";".join(relations) or "none", ";".join(actions)])
+
+
+def run(rules, text, mode, cache_dir):
+    depedit = DepEdit()
+    depedit.quiet = True
+    depedit.add_transformation(*rules)
+    if mode == "compiled":
+        depedit.compile_transformations()
+    elif mode == "cached":
+        depedit.compile_transformations(cache_dir)
+    elif mode == "warm-up":
+        depedit.warmup = 10
+        depedit.compiled = True
+    try:
+        return depedit.run_depedit(text)
+    except SystemExit:
+        return "EXIT"
+    except Exception as e:
+        return "ERROR " + type(e).__name__ + ": " + str(e)
+
+
+def main(options):
+    rand = random.Random(options.seed)
+    cache_dir = tempfile.mkdtemp(prefix="depedit_check_")
+    mismatches = 0
+    try:
+        for trial in range(options.trials):
+            rules = [random_rule(rand) for _ in range(rand.randint(1, 4))]
+            text = "\n\n".join(random_sentence(rand, rand.randint(1, 9)) for _ in range(20))
+            # The cached mode runs twice, first writing the generated source and then reading it back
+            outputs = [run(rules, text, mode, cache_dir) for mode in MODES + ["cached"]]
+            if len(set(outputs)) > 1:
+                mismatches += 1
+                print("Mismatch in trial " + str(trial) + " (seed " + str(options.seed) + ")", file=sys.stderr)
+                for rule in rules:
+                    print("  rule: " + rule.replace("\t", "\\t"), file=sys.stderr)
+                lines = [output.split("\n") for output in outputs]
+                line_num = min(i for i in range(max(len(mode_lines) for mode_lines in lines))
+                               if len(set(tuple(mode_lines[i:i + 1]) for mode_lines in lines)) > 1)
+                print("  first difference on output line " + str(line_num + 1) + ":", file=sys.stderr)
+                for mode, mode_lines in zip(MODES + ["cached again"], lines):
+                    print("  " + mode + ": " + "\n".join(mode_lines[line_num:line_num + 1]), file=sys.stderr)
+    finally:
+        shutil.rmtree(cache_dir)
+    print(str(options.trials) + " trials, " + str(mismatches) + " mismatches")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare compiled and interpreted DepEdit output on random rules")
+    parser.add_argument('-s', '--seed', action="store", type=int, default=0, help="Random seed")
+    parser.add_argument('-n', '--trials', action="store", type=int, default=300, help="Number of random rule sets")
+    main(parser.parse_args())